@@ -1,11 +1,16 @@
 """API Server for Forkd"""
 
 from flask import (Flask, request, jsonify)
+from flask.json.provider import JSONProvider
+from asgiref.wsgi import WsgiToAsgi
+import orjson
 from dotenv import load_dotenv # COMMENT OUT WHEN BUILDING IMAGE
 import requests
+from requests.adapters import HTTPAdapter
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from werkzeug.http import HTTP_STATUS_CODES
 import cloudinary.uploader
+import redis
 
 import model
 import permissions_helper as ph
@@ -22,8 +27,32 @@ CLOUDINARY_SECRET = os.environ['CLOUDINARY_SECRET']
 RDS_URI = os.environ['RDS_URI'] # for prod
 DEV_URI = os.environ['DEV_URI']
 CLOUD_NAME = 'dw0c9rwkd'
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+USERNAME_RE = re.compile(r'[A-Za-z0-9_-]+') # compiled once; usernames are alphanumeric/underscore/dash only
+
+# token->user_id cache; every call is wrapped so the app degrades to plain
+# DB lookups if Redis is unreachable
+cache = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+# keep-alive session for Spoonacular calls, so repeat requests reuse the
+# TCP+TLS connection instead of re-handshaking every time
+spoonacular = requests.Session()
+spoonacular.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+class OrJSONProvider(JSONProvider):
+    """Serialize responses with orjson's C encoder instead of stdlib json.
+
+    Handles datetimes natively (ISO 8601), so dict-heavy payloads like
+    timelines and user listings skip the pure-Python encoder entirely.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
 app.secret_key = os.environ['FLASK_KEY']
 # model.connect_to_db(app, RDS_URI, False)      # using Amazon RDS instance, uncomment to build image
 
@@ -58,15 +87,49 @@ def basic_auth_error(status):
 @app.route('/api/tokens', methods=['POST']) # login - give a token
 @basic_auth.login_required
 def get_token():
-    token = basic_auth.current_user().get_token()
+    user = basic_auth.current_user()
+    token = user.get_token()
     model.db.session.commit()
+    _cache_token(token, user)
     return {'token': token}, 200
 
 token_auth = HTTPTokenAuth()
 
+def _cache_token(token: str, user: model.User) -> None:
+    """Cache a token->user_id mapping, expiring when the token does."""
+    ttl = int((user.token_expiration - datetime.utcnow()).total_seconds())
+    if ttl <= 0:
+        return
+    try:
+        cache.setex(f'tok:{token}', ttl, user.id)
+    except redis.RedisError:
+        pass
+
 @token_auth.verify_token
 def verify_token(token):
-    return model.User.check_token(token) if token else None
+    if not token:
+        return None
+    # cache hit skips the token-index scan; key TTL matches token expiry,
+    # so anything cached is still valid
+    try:
+        cached_id = cache.get(f'tok:{token}')
+    except redis.RedisError:
+        cached_id = None
+    if cached_id:
+        user = model.User.get_by_id(int(cached_id))
+        # re-check the token against the loaded row (free -- no extra query):
+        # revocation must hold even if revoke_token's best-effort cache delete
+        # was dropped while Redis was unreachable
+        if user and user.token == token and user.token_expiration > datetime.utcnow():
+            return user
+        try:
+            cache.delete(f'tok:{token}') # stale entry: token revoked or rotated
+        except redis.RedisError:
+            pass
+    user = model.User.check_token(token)
+    if user and user != 'expired':
+        _cache_token(token, user)
+    return user
 
 @token_auth.error_handler
 def token_auth_error(status):
@@ -78,7 +141,12 @@ def token_auth_error(status):
 def revoke_token():
     if token_auth.current_user() == 'expired':
         return '', 204
-    
+
+    try:
+        cache.delete(f'tok:{token_auth.current_user().token}')
+    except redis.RedisError:
+        pass
+
     if token_auth.current_user().is_temp_user:
         submitter = token_auth.current_user()
         for recipe in submitter.recipes:
@@ -109,10 +177,22 @@ def get_user():
     return user_dict
 
 ################ Endpoint '/api/users' ############################
-# GET -- return all users; unused in Frontend
+# GET -- return users, keyset-paginated; unused in Frontend
 @app.route('/api/users')
 def read_all_users():
-    return [user.to_dict() for user in model.User.get_all()], 200
+    """Lists users a page at a time.
+
+    Accepts:    ?after=<id cursor, default 0> &limit=<page size, default 50, max 100>
+    Returns:    {users: <list of user dicts>,
+                 next: <cursor to pass as `after` for the next page, or null on the last page>}
+    """
+    after = request.args.get('after', 0, type=int)
+    # clamp to 1..100: limit=0 would make an empty page look full (bogus
+    # cursor math), and a negative limit is invalid SQL on Postgres
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+    users = model.User.get_page(after, limit)
+    next_cursor = users[-1].id if len(users) == limit else None
+    return {'users': [user.to_dict() for user in users], 'next': next_cursor}, 200
 
 # POST -- create a new user
 @app.route('/api/users', methods=['POST'])
@@ -134,7 +214,7 @@ def create_user():
 
     ### input validation
     # validate that fields are not empty!!!! and that username is valid format
-    if not all([given_email, given_password, given_username]) or not re.match(r'^[A-Za-z0-9_-]+$',given_username):
+    if not all([given_email, given_password, given_username]) or not USERNAME_RE.fullmatch(given_username):
         return error_response(400)
     # validate that email or username not already taken
     if model.User.get_by_email(given_email):
@@ -186,7 +266,10 @@ def read_user_profile(username):
         status = 401
         viewer = None
 
-    owner = model.User.get_by_username(username)
+    # only the own-profile branch serializes owner.recipes directly, so only
+    # eager-load the tree when the viewer is looking at their own profile
+    is_own_profile = viewer is not None and viewer.username == username
+    owner = model.User.get_by_username(username, with_recipes=is_own_profile)
     if not owner:
         return error_response(404)
 
@@ -261,7 +344,7 @@ def update_user(id):
         submitter.email = new_email
     elif new_username:
         # check that username isn't already taken, and is valid
-        if not re.match(r'^[A-Za-z0-9_-]+$',new_username):
+        if not USERNAME_RE.fullmatch(new_username):
             return {'message':'Username invalid'}, 400
         if model.User.get_by_username(new_username):
             return {'message':'Username already taken'}, 409
@@ -328,19 +411,22 @@ def create_new_recipe():
     is_public = params.get('set_is_public')
     is_experiments_public = params.get('set_is_exps_public')
 
-    submitter = token_auth.current_user()
-    now = datetime.utcnow()
-
     # make sure title, ingredients, and instructions are not empty
+    # (validate before touching the session at all)
     if not title and not ingredients and not instructions:
         return error_response(400)
 
-    # db changes
-    newRecipe = model.Recipe.create(owner=submitter, modified_on=now, 
-                                    is_public=is_public, is_experiments_public=is_experiments_public,
-                                    source_url=given_url, forked_from=forked_from_id) # create recipe
-    model.Edit.create(newRecipe, title, description, ingredients, instructions, img_url, now, submitter) # create first edit
-    model.db.session.add(newRecipe)
+    submitter = token_auth.current_user()
+    now = datetime.utcnow()
+
+    # db changes -- recipe and first edit go to the session together, flushed
+    # once at commit instead of relying on cascade plus an autoflush
+    with model.db.session.no_autoflush:
+        newRecipe = model.Recipe.create(owner=submitter, modified_on=now,
+                                        is_public=is_public, is_experiments_public=is_experiments_public,
+                                        source_url=given_url, forked_from=forked_from_id) # create recipe
+        first_edit = model.Edit.create(newRecipe, title, description, ingredients, instructions, img_url, now, submitter) # create first edit
+    model.db.session.add_all([newRecipe, first_edit])
 
     try:
         model.db.session.commit()
@@ -365,7 +451,9 @@ def read_recipe_timeline(id):
                          recipe_id: <int, unique id of corresponding recipe>,
                          item_type: "edit",
                          commit_by, commit_by_avatar, commit_date,
-                         title, description, ingredients, instructions:,
+                         title, description,
+                         ingredients, instructions: only with ?full=1 -- list
+                            views don't need the bulky text columns,
                          (included, but as yet unused: img_url, pending_approval)
                         }
                     experiments: list of dicts 
@@ -387,13 +475,14 @@ def read_recipe_timeline(id):
         current_user = None
         response_code = 401
     query_owner = request.args.get('owner')
-    recipe = model.Recipe.get_by_id(id)
+    full = request.args.get('full') == '1'
+    recipe = model.Recipe.get_by_id_with_timeline(id, full=full)
     if not recipe:
         return error_response(404)
     recipe_owner = recipe.owner.username
     if query_owner and query_owner != recipe_owner:
         return error_response(404)
-    timeline_items = ph.get_timeline(current_user.id if current_user else None, id)
+    timeline_items = ph.get_timeline(current_user.id if current_user else None, recipe)
     if not timeline_items:
         return error_response(404)
     if not timeline_items[0]:
@@ -445,14 +534,14 @@ def create_new_exp(id):
     commit_msg = params.get('commit_msg')
     notes = params.get('notes')
     now = datetime.utcnow()
-    this_recipe = model.Recipe.get_by_id(id)
-    if not this_recipe:
-        return error_response(404)
     submitter = token_auth.current_user()
+    row = model.Recipe.get_with_permission_for(id, submitter.id)
+    if not row:
+        return error_response(404)
+    this_recipe, permission = row
 
     # check that submitter is allowed to add a new experiment to given recipe
     if this_recipe.user_id != submitter.id:
-        permission = model.Permission.get_by_user_and_recipe(submitter.id, id)
         if not permission or not permission.can_experiment:
             return error_response(403)
     
@@ -497,15 +586,15 @@ def create_new_edit(id):
     instructions = params.get('instructions')
     img_url = params.get('img-url')
     now = datetime.utcnow()
-    this_recipe = model.Recipe.get_by_id(id)
-    if not this_recipe:
-        return error_response(404)
     submitter = token_auth.current_user()
+    row = model.Recipe.get_with_permission_for(id, submitter.id)
+    if not row:
+        return error_response(404)
+    this_recipe, permission = row
     pending_approval = False
-    
+
     # check that submitter is allowed to add a new edit to given recipe
     if this_recipe.user_id != submitter.id:
-        permission = model.Permission.get_by_user_and_recipe(submitter.id, id)
         if not permission or not permission.can_edit:
             return error_response(403)
 
@@ -739,7 +828,7 @@ def delete_edit(id):
     if not this_edit:
         return error_response(404)
     # NOT ALLOWED TO DELETE THE FIRST (CREATION) EDIT
-    if this_edit == this_edit.recipe.edits[-1]:
+    if this_edit.get_previous() is None:
         return error_response(409, 'Cannot delete creation edit')
 
     # check if sender is allowed to delete
@@ -825,25 +914,46 @@ def edit_experiment(id):
 
 ################ Endpoint '/api/extract-recipe' ############################
 # GET, with url as a query string
+def _fetch_spoonacular(given_url: str) -> dict | None:
+    """Call Spoonacular's extract endpoint, caching responses in Redis for a day.
+
+    Extraction is deterministic for a given url and the API is billed per call,
+    so the cache also acts as a soft rate-limiter on the external quota.
+    """
+    key = f'spoon:{given_url}'
+    try:
+        hit = cache.get(key)
+    except redis.RedisError:
+        hit = None
+    if hit:
+        return orjson.loads(hit)
+
+    url = f'https://api.spoonacular.com/recipes/extract'
+    res = spoonacular.get(url, params={'apiKey':SPOONACULAR_KEY,
+                                       'url': given_url,
+                                       'forceExtraction':'false',
+                                       'analyze': 'false',
+                                       'includeNutrition':'false',
+                                       'includeTaste':'false'},
+                          timeout=5)
+    if res.status_code != 200:
+        return None
+    recipe_details = res.json()
+    try:
+        cache.setex(key, 86400, orjson.dumps(recipe_details))
+    except redis.RedisError:
+        pass
+    return recipe_details
+
 @app.route('/api/extract-recipe')
 def extract_recipe_from_url():
     """Uses Spoonacular API to extract recipe details from given url. Expects url to be extracted from as a GET query string"""
     given_url = request.args.get('url')
-    # return info from spoonacular 
+    # return info from spoonacular
     # (just title, desc, ingredients, instructions, img)
-
-    url = f'https://api.spoonacular.com/recipes/extract'
-    res = requests.get(url, {'apiKey':SPOONACULAR_KEY,
-                             'url': given_url,
-                             'forceExtraction':'false',
-                             'analyze': 'false',
-                             'includeNutrition':'false',
-                             'includeTaste':'false'})
-    
-    if res.status_code != 200:
+    recipe_details = _fetch_spoonacular(given_url)
+    if recipe_details is None:
         return error_response(400,'External API call failed')
-    
-    recipe_details = res.json()
 
     return {'title': recipe_details.get('title'),
             'desc': f"Grabbed via Spoonacular from {recipe_details.get('sourceName')}\nGiven summary: {recipe_details.get('summary')}\nGiven license: {recipe_details.get('license')}",
@@ -853,6 +963,10 @@ def extract_recipe_from_url():
 
 
 
+# ASGI entry point, for serving with
+# uvicorn api_server:asgi_app --loop uvloop --http httptools
+asgi_app = WsgiToAsgi(app)
+
 if __name__ == '__main__':
     model.connect_to_db(app, DEV_URI, False)     # for local dev
     app.run(host='0.0.0.0', debug=True)
@@ -1,7 +1,8 @@
 """Models for Forkd (recipe journaling app)"""
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import Mapped
+from sqlalchemy import and_
+from sqlalchemy.orm import Mapped, selectinload, joinedload, raiseload, defer, load_only, lazyload
 from datetime import datetime, timedelta
 from passlib.hash import argon2
 import base64
@@ -9,13 +10,37 @@ import os
 
 db = SQLAlchemy()
 
+# argon2id with explicitly pinned costs, so login latency doesn't drift with
+# passlib's defaults; verify still accepts hashes made under older parameters
+argon2id = argon2.using(type='ID', time_cost=2, memory_cost=65536, parallelism=1)
+
 # Mixin
 class DictableColumn():
     """Mixin to make jsonifying SQLAlchemy model objects easier"""
+
+    @classmethod
+    def _build_serializer(cls):
+        """Generate and cache a static serializer over this class's mapped columns.
+
+        Built once per class on first use (the mapper isn't configured yet at
+        class-creation time), then every to_dict call is straight dict lookups --
+        no __dict__ scan, isinstance filtering, or comprehension overhead.
+        Columns that aren't loaded are skipped, same as the old __dict__ scan.
+        """
+        lines = ['def _serialize(self):', '    d = self.__dict__', '    out = {}']
+        for col in cls.__mapper__.columns:
+            lines.append(f'    if {col.key!r} in d: out[{col.key!r}] = d[{col.key!r}]')
+        lines.append('    return out')
+        namespace = {}
+        exec('\n'.join(lines), namespace)
+        cls._serialize = namespace['_serialize']
+        return cls._serialize
+
     def to_dict(self):
-        crowded_dict = self.__dict__
-        return {key:val for key, val in crowded_dict.items() 
-                if isinstance(val,(str,int,float,bool, dict, type(None), datetime))}
+        serializer = type(self).__dict__.get('_serialize')
+        if serializer is None:
+            serializer = type(self)._build_serializer()
+        return serializer(self)
 
 # DATA MODEL
 # Users
@@ -50,37 +75,48 @@ class User(DictableColumn, db.Model):
     @classmethod
     def create(cls, email: str, password: str, username: str, is_temp_user: bool = False) -> 'User':
         """Create and return a new user."""
-        password = argon2.hash(password)
+        password = argon2id.hash(password)
         return cls(email=email, password=password, username=username, is_temp_user=is_temp_user)
     
     @classmethod
-    def get_all(cls):
-        return cls.query.all()
-    
+    def get_page(cls, after: int = 0, limit: int = 50) -> list['User']:
+        """Keyset-paginated listing: up to limit users with id > after, ascending.
+
+        Only loads the columns the listing serializes, so the payload and the
+        bytes off disk stay narrow no matter how big the table gets.
+        """
+        return db.session.execute(
+            db.select(cls)
+            .options(load_only(cls.id, cls.username, cls.img_url))
+            .where(cls.id > after)
+            .order_by(cls.id)
+            .limit(limit)
+        ).scalars().all()
+
     @classmethod
     def get_by_id(cls, id: int) -> 'User':
-        return cls.query.get(id)
-    
+        return db.session.get(cls, id)
+
     @classmethod
-    def get_by_username(cls, username: str) -> 'User':
-        try:
-            return cls.query.filter_by(username=username).one()
-        except:
-            return None 
-    
+    def get_by_username(cls, username: str, with_recipes: bool = False) -> 'User':
+        stmt = db.select(cls).filter_by(username=username)
+        if with_recipes:
+            # profile views serialize the user's recipes (and each recipe's
+            # latest edit for title/description), so batch-load the tree here
+            # instead of one lazy SELECT per recipe
+            stmt = stmt.options(selectinload(cls.recipes).selectinload(Recipe.edits))
+        return db.session.execute(stmt).scalar_one_or_none()
+
     @classmethod
     def get_by_email(cls, email: str) -> 'User':
-        try:
-            return cls.query.filter_by(email=email).one()
-        except:
-            return None 
+        return db.session.execute(db.select(cls).filter_by(email=email)).scalar_one_or_none()
 
     # Instance Login methods
     def is_password_correct(self, given_password: str) -> bool:
-        return argon2.verify(given_password, self.password)
-    
+        return argon2id.verify(given_password, self.password)
+
     def change_password(self, new_password: str) -> bool:
-        new_password = argon2.hash(new_password)
+        new_password = argon2id.hash(new_password)
         self.password = new_password
     
     def get_token(self, expires_in_hrs: int = 10):
@@ -97,21 +133,40 @@ class User(DictableColumn, db.Model):
     
     @staticmethod
     def check_token(token):
-        user = User.query.filter_by(token=token).first()
+        user = db.session.execute(
+            db.select(User).filter_by(token=token)
+        ).scalar_one_or_none()
         if user is None:
             return None
         elif user.token_expiration < datetime.utcnow():
             return 'expired'
     
         return user
-    
+
+    @staticmethod
+    def check_tokens(tokens: list[str]) -> dict[str, 'User']:
+        """Batch version of check_token: verify many tokens with one IN query.
+
+        Returns a dict mapping each still-valid token to its User; expired and
+        unknown tokens are simply absent. For callers that hold a batch of
+        tokens at once (e.g. websocket/streaming auth) instead of looping
+        check_token per token.
+        """
+        if not tokens:
+            return {}
+        users = db.session.execute(
+            db.select(User).where(User.token.in_(tokens),
+                                  User.token_expiration > datetime.utcnow())
+        ).scalars().all()
+        return {user.token: user for user in users}
+
     # to_dict method == exclude password, token, token_expiration
     def to_dict(self):
         dirty_dict = super().to_dict()
-        del dirty_dict['password']
-        del dirty_dict['email']
-        del dirty_dict['token']
-        del dirty_dict['token_expiration']
+        dirty_dict.pop('password', None)
+        dirty_dict.pop('email', None)
+        dirty_dict.pop('token', None)
+        dirty_dict.pop('token_expiration', None)
 
         return dirty_dict
 
@@ -130,10 +185,13 @@ class Recipe(DictableColumn, db.Model):
     is_public = db.Column(db.Boolean) # default true
     is_experiments_public = db.Column(db.Boolean) # default true
 
+    # covers User.recipes (filter by owner, newest first) without a sort node
+    __table_args__ = (db.Index('ix_recipes_user_lastmod', 'user_id', db.text('last_modified DESC')),)
+
     # Relationships
-    owner = db.relationship('User', back_populates='recipes') # one corresponding User object
+    owner = db.relationship('User', back_populates='recipes', lazy='joined') # one corresponding User object
     experiments = db.relationship('Experiment', back_populates='recipe', order_by='desc(Experiment.commit_date)', cascade='save-update, merge, delete') # list of corresponding Experiment objects
-    edits = db.relationship('Edit', back_populates='recipe', order_by='desc(Edit.commit_date)', cascade='save-update, merge, delete', lazy='selectin') # list of corresponding Edit objects
+    edits = db.relationship('Edit', back_populates='recipe', order_by='desc(Edit.commit_date)', cascade='save-update, merge, delete') # list of corresponding Edit objects
     parent = db.relationship('Recipe', backref='children', remote_side=[id])
     permissions = db.relationship('Permission', back_populates='recipe')
 
@@ -154,7 +212,47 @@ class Recipe(DictableColumn, db.Model):
     
     @classmethod
     def get_by_id(cls, id: int) -> 'Recipe':
-        return cls.query.get(id)
+        return db.session.get(cls, id)
+
+    @classmethod
+    def get_by_id_with_timeline(cls, id: int, full: bool = False) -> 'Recipe':
+        """Get a recipe with everything the timeline view serializes, in one round-trip batch.
+
+        Eager-loads edits, experiments (plus their committers), the owner, and the
+        parent recipe's owner so serializing the timeline never falls back to
+        per-row lazy SELECTs. raiseload('*') makes any remaining lazy access blow
+        up loudly instead of silently re-introducing N+1.
+
+        Unless full is True, each edit's bulky ingredients/instructions Text
+        columns stay in the DB; to_dict skips unloaded columns, so lean edits
+        just omit those keys.
+        """
+        edit_loader = selectinload(cls.edits).options(selectinload(Edit.committer), raiseload('*'))
+        if not full:
+            edit_loader = edit_loader.options(defer(Edit.ingredients), defer(Edit.instructions))
+        return db.session.get(cls, id,
+                              options=[edit_loader,
+                                       selectinload(cls.experiments).options(selectinload(Experiment.committer), raiseload('*')),
+                                       joinedload(cls.owner),
+                                       joinedload(cls.parent).joinedload(cls.owner),
+                                       raiseload('*')])
+
+    @classmethod
+    def get_with_permission_for(cls, recipe_id: int, user_id: int) -> tuple['Recipe', 'Permission'] | None:
+        """Get a recipe and the given user's Permission row for it in one query.
+
+        Returns a (Recipe, Permission) tuple where Permission is None if the user
+        has no row, or None if the recipe doesn't exist. Saves the write
+        endpoints a second round-trip for the permission check. The lazyload
+        guards keep this a single statement even if the collections ever grow
+        eager mapper-level strategies again.
+        """
+        return (db.session.query(cls, Permission)
+                .outerjoin(Permission, and_(Permission.recipe_id == cls.id,
+                                            Permission.user_id == user_id))
+                .options(lazyload(cls.edits), lazyload(cls.experiments))
+                .filter(cls.id == recipe_id)
+                .one_or_none())
 
     # instance methods
     def update_last_modified(self, modified_date: datetime) -> None:
@@ -221,7 +319,7 @@ class Experiment(DictableColumn, db.Model):
     
     @classmethod
     def get_by_id(cls, id: int) -> 'Experiment':
-        return cls.query.get(id)
+        return db.session.get(cls, id)
 
 # Edits
 class Edit(DictableColumn, db.Model):
@@ -243,6 +341,9 @@ class Edit(DictableColumn, db.Model):
     # on submission: pending_approval -> true
     # if approved: pending_approval -> null, treated as normal edit
 
+    # covers get_previous (filter by recipe, walk by date)
+    __table_args__ = (db.Index('ix_edits_recipe_date', 'recipe_id', 'commit_date'),)
+
     # Relationships
     recipe = db.relationship('Recipe', back_populates='edits') # one corresponding Recipe object
     committer = db.relationship('User', back_populates='committed_edits',lazy="selectin")
@@ -274,8 +375,21 @@ class Edit(DictableColumn, db.Model):
     
     @classmethod
     def get_by_id(cls, id: int) -> 'Edit':
-        return cls.query.get(id)
-    
+        return db.session.get(cls, id)
+
+    # instance methods
+    def get_previous(self) -> 'Edit | None':
+        """Return the next-older edit on the same recipe, or None if this is the creation edit.
+
+        One indexed query -- doesn't materialize the recipe's whole edits
+        collection just to find a neighbour.
+        """
+        return (db.session.query(Edit)
+                .filter(Edit.recipe_id == self.recipe_id,
+                        Edit.commit_date < self.commit_date)
+                .order_by(Edit.commit_date.desc())
+                .first())
+
 
 # Permissions
 class Permission(db.Model):
@@ -289,6 +403,10 @@ class Permission(db.Model):
     can_experiment = db.Column(db.Boolean)
     can_edit = db.Column(db.Boolean)
 
+    # the composite primary key already indexes (user_id, recipe_id);
+    # this covers lookups that filter by recipe first (shared-with lists, permission joins)
+    __table_args__ = (db.Index('ix_perm_recipe_user', 'recipe_id', 'user_id', unique=True),)
+
     # Relationships
     recipe = db.relationship('Recipe', back_populates='permissions') # one corresponding Recipe object
     user = db.relationship('User', back_populates='permissions')
@@ -297,17 +415,31 @@ class Permission(db.Model):
     ### Methods
     @classmethod
     def get_by_user_and_recipe(cls, user_id, recipe_id):
-        return cls.query.get({'user_id': user_id, 'recipe_id':recipe_id})
+        return db.session.get(cls, {'user_id': user_id, 'recipe_id':recipe_id})
     
     @classmethod
     def create(cls, user_id, recipe_id, can_experiment=True, can_edit=True):
         return cls(user_id=user_id,recipe_id=recipe_id, can_experiment=can_experiment, can_edit=can_edit)
 
 # CONNECTING TO DB
-def connect_to_db(flask_app, db_uri="/test", echo=True):
+def connect_to_db(flask_app, db_uri="/test", echo=None):
+    # statement logging formats and writes every query, which sits directly on
+    # the query path -- keep it off unless asked for via SQL_ECHO=1
+    if echo is None:
+        echo = bool(os.environ.get('SQL_ECHO'))
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{db_uri}'
     flask_app.config['SQLALCHEMY_ECHO'] = echo
     flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # pool sized so concurrent workers aren't queueing on the default 5+10;
+    # pre-ping/recycle drop connections RDS has idled out, and the statement
+    # timeout keeps a runaway query from pinning a pooled connection
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 40,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'connect_args': {'options': '-c statement_timeout=5000'},
+    }
 
     db.app = flask_app
     db.init_app(flask_app)
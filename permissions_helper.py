@@ -1,6 +1,7 @@
 from model import (db, connect_to_db, User, 
                    Recipe, Edit, Experiment, Permission)
 from sqlalchemy import select, union, desc
+from sqlalchemy.orm import selectinload
 
 def get_shared_with_me(me_id: int) -> list('Recipe'):
     """
@@ -10,7 +11,8 @@ def get_shared_with_me(me_id: int) -> list('Recipe'):
     """
    
     # SELECT <Recipe> FROM recipes JOIN permissions WHERE permissions.user_id == <me_id>
-    select_shared_with_me = select(Recipe).join(Recipe.permissions).where(Permission.user_id==me_id)
+    # (batch-load each recipe's edits too -- Recipe.to_dict reads the latest one)
+    select_shared_with_me = select(Recipe).join(Recipe.permissions).where(Permission.user_id==me_id).options(selectinload(Recipe.edits))
     return db.session.scalars(select_shared_with_me).all()
 
 def get_viewable_recipes(owner_id: int, viewer_id: int | None) -> list[Recipe]:
@@ -24,7 +26,7 @@ def get_viewable_recipes(owner_id: int, viewer_id: int | None) -> list[Recipe]:
     # ORDER BY Recipe.last_modified 
     select_shared_with_viewer = select(Recipe).join(Recipe.permissions).where(Permission.user_id==viewer_id).where(Recipe.user_id==owner_id)
     union_query = union(select_owners_public_recipes, select_shared_with_viewer).order_by(desc(Recipe.last_modified))
-    union_query = select(Recipe).from_statement(union_query)
+    union_query = select(Recipe).from_statement(union_query).options(selectinload(Recipe.edits))
     return db.session.scalars(union_query).all()
 
 def get_recipe_shared_with(recipe: Recipe) -> list[tuple]:
@@ -39,41 +41,43 @@ def can_user_view(user: User, recipe: Recipe) -> bool:
     select_permission = select(Permission).where(Permission.user_id==user.id).where(Permission.recipe_id==recipe.id)
     return bool(db.session.execute(select_permission).one_or_none())
 
-def get_timeline(viewer_id: int | None, recipe_id: int): # -> list('Edit'|'Experiment'):
-    """Given a user's id and a recipe id, return a list of timeline items (experiments and edits) in descending chrono order that the user is allowed to view
-    
+def get_timeline(viewer_id: int | None, this_recipe: Recipe | None): # -> list('Edit'|'Experiment'):
+    """Given a user's id and a loaded recipe, return a list of timeline items (experiments and edits) in descending chrono order that the user is allowed to view
+
+    Expects the recipe from Recipe.get_by_id_with_timeline, whose full flag
+    controls whether edit dicts carry the bulky ingredients/instructions columns.
+
     Returns a tuple:
         (dict ->    {edits: list,
                     experiments: list -- will not be included if no permission to view experiments},
         bool -> whether viewer has experiment permissions on the recipe,
-        bool -> whether viewer has edit permissions on the recipe ) 
+        bool -> whether viewer has edit permissions on the recipe )
     """
-    
-    this_recipe = Recipe.get_by_id(recipe_id)
+
     if not this_recipe:
         return None
     timeline_items = None
     can_experiment = False
     can_edit = False
     this_permission = None
-    edits = [edit.to_dict() for edit in this_recipe.edits]
-    exps = [exp.to_dict() for exp in this_recipe.experiments]
     if this_recipe.user_id == viewer_id:
         can_experiment = True
         can_edit = True
-        timeline_items = {'edits':edits, 'experiments':exps}
+        timeline_items = {'edits': [edit.to_dict() for edit in this_recipe.edits],
+                          'experiments': [exp.to_dict() for exp in this_recipe.experiments]}
         return (timeline_items, can_experiment, can_edit)
     elif viewer_id is not None:
-        this_permission = Permission.get_by_user_and_recipe(viewer_id, recipe_id) # returns the match, or None
+        this_permission = Permission.get_by_user_and_recipe(viewer_id, this_recipe.id) # returns the match, or None
         if this_permission is not None:
             can_experiment = this_permission.can_experiment
             can_edit = this_permission.can_edit
-    
-    if this_recipe.is_public:
-        timeline_items = {'edits':edits}
-    
+
+    # serialize only what this viewer is actually allowed to see
     if this_recipe.is_experiments_public or this_permission is not None:
-        timeline_items = {'edits':edits, 'experiments':exps}
+        timeline_items = {'edits': [edit.to_dict() for edit in this_recipe.edits],
+                          'experiments': [exp.to_dict() for exp in this_recipe.experiments]}
+    elif this_recipe.is_public:
+        timeline_items = {'edits': [edit.to_dict() for edit in this_recipe.edits]}
     return (timeline_items, can_experiment, can_edit)
     
 
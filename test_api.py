@@ -249,6 +249,58 @@ class TestPermissions(LoggedInUser, unittest.TestCase):
 # and check if the other user can see it as they should
 # and if they can edit it as they should
 
+class TestTimelinePayload(unittest.TestCase):
+    def setUp(self):
+        # start each test from a clean identity map, like a fresh per-request
+        # session -- otherwise already-loaded edits hide the deferred columns
+        model.db.session.expunge_all()
+
+    def test_timeline_is_lean_by_default(self):
+        response = client.get('/api/recipes/3') # edits and experiments both public
+        self.assertEqual(response.status_code, 200)
+        for edit in response.json['timeline_items']['edits']:
+            self.assertIn('title', edit)
+            self.assertNotIn('ingredients', edit, 'lean timeline should leave text columns in the db')
+            self.assertNotIn('instructions', edit, 'lean timeline should leave text columns in the db')
+
+    def test_timeline_full_param_restores_text_columns(self):
+        response = client.get('/api/recipes/3?full=1')
+        self.assertEqual(response.status_code, 200)
+        for edit in response.json['timeline_items']['edits']:
+            self.assertEqual(edit['ingredients'], 'ingredients')
+            self.assertEqual(edit['instructions'], 'instructions')
+
+class TestUserPagination(unittest.TestCase):
+    def test_response_shape(self):
+        response = client.get('/api/users')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('users', response.json)
+        self.assertIn('next', response.json)
+
+    def test_keyset_cursor_pages_through(self):
+        response = client.get('/api/users?limit=1')
+        self.assertEqual(len(response.json['users']), 1)
+        cursor = response.json['next']
+        self.assertEqual(cursor, response.json['users'][0]['id'])
+        next_page = client.get(f'/api/users?after={cursor}&limit=1')
+        for user in next_page.json['users']:
+            self.assertGreater(user['id'], cursor)
+
+    def test_limit_zero_is_clamped(self):
+        response = client.get('/api/users?limit=0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['users']), 1)
+
+    def test_negative_limit_is_clamped(self):
+        response = client.get('/api/users?limit=-5')
+        self.assertEqual(response.status_code, 200)
+
+    def test_past_the_end_page_is_empty_with_null_cursor(self):
+        response = client.get('/api/users?after=999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['users'], [])
+        self.assertIsNone(response.json['next'])
+
 # TODO test delete of edit, experiment, recipe
 # by owner >> done in TestCreateAndDelete!
 # TODO by other user